@@ -23,24 +23,47 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #|          Import Modules           |
 # \---------------------------------/
 import os
-from sys import exit
+from sys import exit, intern
 
 import re
+import json
+import pickle
 import platform
 from pathlib import Path
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 __author__ = 'Dale A. Osborne'
 __copyright__ = 'Copyright 2021, Dale Osborne'
 __license__ = 'GPL'
 __version__ = '1.1.5'
 
+CACHE_VERSION = 1 # Bump when read_material's output changes, to discard old material caches
+
 
 
 # /---------------------------------\
 #|          Get Cura Config          |
 # \---------------------------------/
-# Windows
-if platform.system() == 'Windows':
+def _vk(x):
+    '''Sort key for Cura config folder names, e.g. '5.10' -> (5, 10)'''
+    try:
+        return tuple(int(p) for p in x.split('.'))
+    except ValueError:
+        return (0,)
+
+def _spoolmaker_dir():
+    '''Returns the per-user directory SpoolMaker keeps its caches in'''
+    if platform.system() == 'Windows':
+        return os.path.join(os.getenv('LOCALAPPDATA') or os.path.join(str(Path.home()), 'AppData', 'Local'), 'SpoolMaker')
+    if platform.system() == 'Darwin':
+        return os.path.join(str(Path.home()), 'Library', 'Caches', 'SpoolMaker')
+    return os.path.join(os.getenv('XDG_CACHE_HOME') or os.path.join(str(Path.home()), '.cache'), 'SpoolMaker')
+
+CACHE_FILE = os.path.join(_spoolmaker_dir(), 'materials.pkl') # Parsed material cache
+
+def _win_sys_mat_dir():
+    '''Looks up the Cura install location in the Windows registry and returns its material directory'''
     from winreg import HKEY_CURRENT_USER, HKEY_LOCAL_MACHINE, KEY_READ, OpenKey, QueryValueEx, EnumKey, QueryInfoKey
     
     def getLatestKey(hKey):
@@ -52,13 +75,6 @@ if platform.system() == 'Windows':
         fList.sort()
         return fList[-1]
     
-    # Get Cura User Directory
-    CURA_USER_DIR = os.path.join(os.getenv('APPDATA'), 'cura')
-    CURA_CONFIGS = [f.name for f in os.scandir(CURA_USER_DIR) if f.is_dir()]
-    CURA_CONFIGS.sort(key=lambda x:int(x.replace(".","" if len(x)>3 else "0")))
-    CURA_USER_MAT_DIR = os.path.join(CURA_USER_DIR, CURA_CONFIGS[-1], 'materials')
-
-    # Get Cura Install Directory
     latestInstalled = None
     curaSysDir = None
     
@@ -89,38 +105,81 @@ if platform.system() == 'Windows':
                 print('Failed to determine Ultimaker Cura install location')
                 exit(1)
     
-    CURA_INSTALL_DIR = curaSysDir
     if latestInstalled == 5:
-        CURA_MAT_DIR = os.path.join(CURA_INSTALL_DIR, 'share', 'cura', 'resources', 'materials')
+        return os.path.join(curaSysDir, 'share', 'cura', 'resources', 'materials')
+    return os.path.join(curaSysDir, 'resources', 'materials')
+
+@lru_cache(maxsize=1)
+def _cura_dirs() -> tuple:
+    '''Locates the Cura user and system material directories. Runs once, on first use'''
+    # Windows
+    if platform.system() == 'Windows':
+        # Get Cura User Directory
+        curaUserDir = os.path.join(os.getenv('APPDATA'), 'cura')
+        curaConfigs = [f.name for f in os.scandir(curaUserDir) if f.is_dir()]
+        curaConfigs.sort(key=_vk)
+        userMatDir = os.path.join(curaUserDir, curaConfigs[-1], 'materials')
+
+        # Get Cura Install Directory, reusing the last run's result until Cura is upgraded.
+        # Upgrades install next to the old version and add a new user config folder
+        pathsFile = os.path.join(_spoolmaker_dir(), 'paths.json')
+        sysMatDir = None
+        try:
+            with open(pathsFile, 'r') as f:
+                paths = json.load(f)
+            if paths['userConfig'] == curaConfigs[-1]:
+                sysMatDir = paths['sysMatDir']
+        except Exception:
+            pass
+
+        if not (sysMatDir and os.path.isdir(sysMatDir)):
+            sysMatDir = _win_sys_mat_dir()
+            try:
+                os.makedirs(os.path.dirname(pathsFile), exist_ok=True)
+                with open(pathsFile, 'w') as f:
+                    json.dump({'userConfig': curaConfigs[-1], 'sysMatDir': sysMatDir}, f)
+            except OSError:
+                print('Failed to write Cura path cache: ', pathsFile)
+
+    elif platform.system() == 'Darwin': # OS X
+        # Get Cura User Directory
+        curaUserDir = str(Path.home()) + '/Library/Application Support/cura/'
+        curaConfigs = [f.name for f in os.scandir(curaUserDir) if f.is_dir()]
+        curaConfigs.sort(key=_vk)
+        userMatDir = os.path.join(curaUserDir, curaConfigs[-1], 'materials')
+        
+        # Set Cura Install Directory
+        sysMatDir = '/Applications/Ultimaker Cura.app/Contents/Resources/resources/materials'
+
+    elif platform.system() == 'Linux':
+        # Get Cura User Directory
+        curaUserDir = str(Path.home()) + '/.local/share/cura/'
+        curaConfigs = [f.name for f in os.scandir(curaUserDir) if f.is_dir()]
+        curaConfigs.sort(key=_vk)
+        userMatDir = os.path.join(curaUserDir, curaConfigs[-1], 'materials')
+        
+        # Set Cura Install Directory
+        sysMatDir = ''
+
     else:
-        CURA_MAT_DIR = os.path.join(CURA_INSTALL_DIR, 'resources', 'materials')
-
-elif platform.system() == 'Darwin': # OS X
-    # Get Cura User Directory
-    CURA_USER_DIR = str(Path.home()) + '/Library/Application Support/cura/'
-    CURA_CONFIGS = [f.name for f in os.scandir(CURA_USER_DIR) if f.is_dir()]
-    CURA_CONFIGS.sort(key=lambda x:int(x.replace(".","" if len(x)>3 else "0")))
-    CURA_USER_MAT_DIR = os.path.join(CURA_USER_DIR, CURA_CONFIGS[-1], 'materials')
-    
-    # Set Cura Install Directory
-    CURA_MAT_DIR = '/Applications/Ultimaker Cura.app/Contents/Resources/resources/materials'
-
-elif platform.system() == 'Linux':
-    # Get Cura User Directory
-    CURA_USER_DIR = str(Path.home()) + '/.local/share/cura/'
-    CURA_CONFIGS = [f.name for f in os.scandir(CURA_USER_DIR) if f.is_dir()]
-    CURA_CONFIGS.sort(key=lambda x:int(x.replace(".","" if len(x)>3 else "0")))
-    CURA_USER_MAT_DIR = os.path.join(CURA_USER_DIR, CURA_CONFIGS[-1], 'materials')
-    
-    # Set Cura Install Directory
-    CURA_MAT_DIR = ''
+        print('Unknown operating system. To override, remove the exit(1) command from the CuraMaterial script.')
+        exit(1)
 
-else:
-    print('Unknown operating system. To override, remove the exit(1) command from the CuraMaterial script.')
-    exit(1)
+    return userMatDir, sysMatDir
 
-print('User Material Directory: ', CURA_USER_MAT_DIR)
-print('System Material Directory: ', CURA_MAT_DIR)
+def __getattr__(name):
+    '''Resolves CURA_USER_MAT_DIR and CURA_MAT_DIR lazily (PEP 562)'''
+    if name == 'CURA_USER_MAT_DIR':
+        return _cura_dirs()[0]
+    if name == 'CURA_MAT_DIR':
+        return _cura_dirs()[1]
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+def describe():
+    '''Prints the material directories in use'''
+    userMatDir, sysMatDir = _cura_dirs()
+    print('User Material Directory: ', userMatDir)
+    print('System Material Directory: ', sysMatDir)
 
 
 
@@ -128,79 +187,110 @@ print('System Material Directory: ', CURA_MAT_DIR)
 #|              Classes              |
 # \---------------------------------/
 class curaMaterial():
+    __slots__ = ('brand', 'material', 'color', 'guid')
+
     def __init__(self, brand:str, material:str, color:str, guid:str):
         self.brand = brand
         self.material = material
         self.color = color
         self.guid = guid
 
+    def displayName(self) -> str:
+        '''Name shown in the material selector, e.g. Generic:PLA (Black)'''
+        return self.brand + ':' + self.material + ' (' + self.color + ')'
+
 
 
 # /---------------------------------\
 #|          Main Functions           |
 # \---------------------------------/
+# Matches the <brand>, <material>, <color> and <GUID> tags of a material profile
+_PAT = re.compile(rb'<(brand|material|color|GUID)>([^<]*)</\1>')
+
 def read_material(cm):
     '''Reads a cura material profile (.xml.fdm_material) and returns a curaMaterial object'''
-    brand = material = color = guid = ''
-    found = [False]*4 # Corresponds with above values. True once that value is found.
-    with open(cm, 'r') as f:
-        for line in f:
-            if all(found):
-                break
-            if '<brand>' in line and not found[0]:
-                data = re.split('<|>| ', line.strip())
-                for b in data[2:]:
-                    if b != '/brand':
-                        brand += b
-                    else:
-                        break
-                found[0] = True
-                continue
-            if '<material>' in line and not found[1]:
-                data = re.split('<|>| ', line.strip())
-                for m in data[2:]:
-                    if m != '/material':
-                        material += m
-                    else:
-                        break
-                found[1] = True
-                continue
-            if '<color>' in line and not found[2]:
-                data = re.split('<|>| ', line.strip())
-                for c in data[2:]:
-                    if c != '/color':
-                        color += c
-                    else:
-                        break
-                found[2] = True
-                continue
-            if '<GUID>' in line and not found[3]:
-                guid = re.split('<|>| ', line.strip())[2]
-                found[3] = True
-                continue
-    return curaMaterial(brand, material, color, guid)
+    # Profiles are small, so read the whole file with a single read call
+    fd = os.open(cm, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        data = os.read(fd, os.fstat(fd).st_size)
+    finally:
+        os.close(fd)
+
+    decoded = {}
+    remaining = 4 # Tags still to be found
+    for m in _PAT.finditer(data):
+        tag, value = m.groups()
+        tag = tag.decode('utf-8').lower()
+        if tag in decoded:
+            continue
+        decoded[tag] = value.decode('utf-8').strip()
+        remaining -= 1
+        if not remaining:
+            break
+    # Brand, material and color repeat across many profiles, so share one copy of each
+    return curaMaterial(intern(decoded.get('brand', '')), intern(decoded.get('material', '')),
+                        intern(decoded.get('color', '')), decoded.get('guid', ''))
+
+def _iter_mats(root):
+    '''Yields the path of every cura material profile in root. Profiles sit directly in the materials folder'''
+    try:
+        it = os.scandir(root)
+    except OSError:
+        return
+    with it:
+        for e in it:
+            if e.name.endswith('.xml.fdm_material') and e.is_file():
+                yield e.path
+
+def _cache_key(dirs, paths):
+    '''Builds the cache key from the cache format, the material directories' mtimes and the number of profiles'''
+    mtimes = [0]
+    for d in dirs:
+        try:
+            mtimes.append(os.stat(d).st_mtime_ns)
+        except OSError:
+            continue
+    return (CACHE_VERSION, dirs, max(mtimes), len(paths))
+
+def iter_all_materials():
+    '''Yields every system and user cura material as a curaMaterial object, as soon as it is parsed'''
+    userMatDir, sysMatDir = _cura_dirs()
+    paths = list(_iter_mats(userMatDir)) + list(_iter_mats(sysMatDir))
+    key = _cache_key((userMatDir, sysMatDir), paths)
+
+    # Reuse the last parse if the material directories haven't changed
+    try:
+        with open(CACHE_FILE, 'rb') as f:
+            cKey, mList = pickle.load(f)
+        if cKey == key:
+            yield from mList
+            return
+    except Exception:
+        pass
+
+    # Profiles are small and I/O bound, so parse them concurrently
+    mList = []
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 4)*4)) as ex:
+        for mat in ex.map(read_material, paths):
+            mList.append(mat)
+            yield mat
+
+    try:
+        os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+        with open(CACHE_FILE, 'wb') as f:
+            pickle.dump((key, mList), f, protocol=5)
+    except Exception:
+        print('Failed to write material cache: ', CACHE_FILE)
 
 def get_all_materials():
     '''Reads all system and user cura materials, and returns a list of curaMaterial objects'''
-    mList = [] # List of materials
-    sList = [] # List of material names for QT combobox
-
-    for root, _, files in os.walk(CURA_USER_MAT_DIR):
-        for file in files:
-            if file.endswith('.xml.fdm_material'):
-                mList.append(read_material(os.path.join(root, file)))
-    for root, _, files in os.walk(CURA_MAT_DIR):
-        for file in files:
-            if file.endswith('.xml.fdm_material'):
-                mList.append(read_material(os.path.join(root, file)))
-    
-    for mat in mList:
-        sList.append(mat.brand + ':' + mat.material + ' (' + mat.color + ')')
-
+    mList = list(iter_all_materials()) # List of materials
+    sList = [mat.displayName() for mat in mList] # List of material names for QT combobox
     return mList, sList
 
 if __name__ == '__main__':
     # If run directly, list installed materials
+    describe()
     materials, _ = get_all_materials()
     for material in materials:
         print('Material: ', material.brand, '/', material.material, '\t', material.color)
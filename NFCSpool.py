@@ -32,8 +32,6 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # /---------------------------------\
 #|          Import Modules           |
 # \---------------------------------/
-import numpy as np
-
 from smartcard.CardRequest import CardRequest
 from smartcard.Exceptions import NoCardException, CardRequestTimeoutException
 from smartcard.CardType import AnyCardType
@@ -41,8 +39,8 @@ from smartcard.System import readers
 from smartcard import util
 
 import uuid
+import struct
 from binascii import hexlify
-from crc8 import crc8
 
 from ndef import message
 from ndef.record import GlobalRecord, Record
@@ -61,6 +59,10 @@ __version__ = '1.1.5'
 get_uid = util.toBytes('FF CA 00 00 00')
 beep = util.toBytes('FF 00 40 00 04 01 00 03 03')
 
+TAG_DATA_LENGTH = 300 # Ultimaker doesn't write past ~225 anyway so read to 300
+# READ BINARY for the tag's data area (from page 4). A read returns 4 pages (16 bytes), writes are limited to 1 page
+read_pages = [[0xff, 0xb0, (p >> 8) & 0xff, p & 0xff, 16] for p in range(4, 4 + TAG_DATA_LENGTH//4, 4)]
+
 '''APDU Responses'''
 sucess = util.toBytes('90 00')
 fail = util.toBytes('63 00')
@@ -69,6 +71,30 @@ notSupported = util.toBytes('6A 81')
 TIMEOUT = 30 # How long to wait for a card in seconds
 DEFAULT_SERIAL = '00:00:00:00:00:00:00'
 
+'''Record field layouts'''
+_S_BB = struct.Struct('>BB')
+_S_Q = struct.Struct('>Q')
+_S_H = struct.Struct('>H')
+_S_STAT = struct.Struct('>BBBLLQ')
+
+'''CRC-8 (poly 0x07, init 0x00) lookup table for the stat record checksum'''
+def _crc8_table(poly=0x07):
+    table = []
+    for i in range(256):
+        c = i
+        for _ in range(8):
+            c = ((c << 1) ^ poly) & 0xff if c & 0x80 else (c << 1) & 0xff
+        table.append(c)
+    return bytes(table)
+
+_CRC8_TABLE = _crc8_table()
+
+def _crc8(buf, tbl=_CRC8_TABLE):
+    c = 0
+    for b in buf:
+        c = tbl[c ^ b]
+    return c
+
 
 # /---------------------------------\
 #|              Classes              |
@@ -80,6 +106,8 @@ class UltimakerMaterialRecord(GlobalRecord):
     _type = 'urn:nfc:ext:ultimaker.nl:material'
     _name = '1'
 
+    _decode_min_payload_length = 42
+
     NO_MATERIAL = uuid.UUID('00000000-0000-0000-0000-000000000000')
 
     def __init__(self, material_id=None, serial='', version=0, compat_version=0,
@@ -93,26 +121,28 @@ class UltimakerMaterialRecord(GlobalRecord):
         self._batch_code = batch_code
 
     def _encode_payload(self):
-        data = self._encode_struct('>BB', self._version, self._compatibility_version)
-        serial = self._serial_number.encode('utf-8') + b'\x00'*14
-        data += serial[:14]
-        data += self._encode_struct('>Q', self._manufacturing_timestamp)
-        data += self._material_id.bytes
-        data += self._encode_struct('>H', self._programming_station_id)
-        data += self._batch_code.encode('utf-8')
-        data += b'\x00' * 108
-
-        return data[0:108]
+        # Fields are written at fixed offsets; unused bytes stay zero
+        buf = bytearray(108)
+        _S_BB.pack_into(buf, 0, self._version, self._compatibility_version)
+        serial = self._serial_number.encode('utf-8')[:14]
+        buf[2:2+len(serial)] = serial
+        _S_Q.pack_into(buf, 16, self._manufacturing_timestamp)
+        buf[24:40] = self._material_id.bytes
+        _S_H.pack_into(buf, 40, self._programming_station_id)
+        batch = self._batch_code.encode('utf-8')[:66]
+        buf[42:42+len(batch)] = batch
+
+        return bytes(buf)
 
     @classmethod
     def _decode_payload(cls, octets, errors):
 
-        version, compat_version = cls._decode_struct('>BB', octets[0:2])
-        serial_number = octets[2:16].decode('utf-8').split('\x00')[0]
-        manufacturing_timestamp = cls._decode_struct('>Q', octets[16:24])
+        version, compat_version = _S_BB.unpack_from(octets, 0)
+        serial_number = octets[2:16].partition(b'\x00')[0].decode('utf-8')
+        manufacturing_timestamp = _S_Q.unpack_from(octets, 16)[0]
         material_id = uuid.UUID(bytes=octets[24:40])
-        programming_station_id = cls._decode_struct('>H', octets[40:42])
-        batch_code = octets[42:106].decode('utf-8').split('\x00')[0]
+        programming_station_id = _S_H.unpack_from(octets, 40)[0]
+        batch_code = octets[42:106].partition(b'\x00')[0].decode('utf-8')
 
         return cls(material_id, serial_number, version, compat_version,
                    manufacturing_ts=manufacturing_timestamp, station_id=programming_station_id, batch_code=batch_code)
@@ -121,6 +151,8 @@ class UltimakerStatRecord(GlobalRecord):
     _type = 'urn:nfc:ext:ultimaker.nl:stat'
     _name = '2'
 
+    _decode_min_payload_length = 20
+
     MATERIAL_UNIT_UNUSED = 0
     MATERIAL_QUANTITY_LENGTH_MM = 1
     MATERIAL_QUANTITY_MASS_GR = 2
@@ -137,9 +169,9 @@ class UltimakerStatRecord(GlobalRecord):
         self._unit = ['N/A', 'mm', 'mg', 'cm³'][self._material_unit]
 
     def _encode_payload(self):
-        data = self._encode_struct('>BBBLLQ', self._version, self._compatibility_version, int(self._material_unit),
-                                   self._material_total, self._material_remaining, self._total_usage_duration)
-        data = data[:19] + crc8(data[:19]).digest()
+        data = _S_STAT.pack(self._version, self._compatibility_version, int(self._material_unit),
+                            self._material_total, self._material_remaining, self._total_usage_duration)
+        data = data[:19] + bytes((_crc8(data[:19]),))
 
         return data[0:20]
 
@@ -147,9 +179,9 @@ class UltimakerStatRecord(GlobalRecord):
     def _decode_payload(cls, octets, errors):
 
         version, compat_version, material_unit, material_total, material_remaining, total_usage_duration = \
-            cls._decode_struct('>BBBLLQ', octets)
+            _S_STAT.unpack_from(octets, 0)
 
-        crc = crc8(octets[:19]).digest()[0]
+        crc = _crc8(octets[:19])
         if octets[19] != crc:
             print('  **** crc mismatch: tag={} self={}'.format(octets[19], crc))
 
@@ -165,11 +197,11 @@ class SigRecord(GlobalRecord):
         self._sig = sig
 
     def _encode_payload(self):
-        return self._encode_struct('>H', self._sig)
+        return _S_H.pack(self._sig)
 
     @classmethod
     def _decode_payload(cls, octets, errors):
-        sig = cls._decode_struct('>H', octets)
+        sig = _S_H.unpack_from(octets, 0)[0]
         return cls(sig)
 
 class MyFilamentSpool:
@@ -179,13 +211,36 @@ class MyFilamentSpool:
                                                 batch_code='123456789AB',
                                                 station_id=0xaffe)
         self.status = UltimakerStatRecord(material_unit=unit, material_total=weight)
+        self._cached = None # Encoded tag data, cleared whenever a stat field changes
+
+    @property
+    def remaining(self):
+        return self.status._material_remaining
+
+    @remaining.setter
+    def remaining(self, value):
+        self.status._material_remaining = value
+        self._cached = None
+
+    @property
+    def usage_duration(self):
+        return self.status._total_usage_duration
+
+    @usage_duration.setter
+    def usage_duration(self, value):
+        self.status._total_usage_duration = value
+        self._cached = None
 
     def data(self) -> bytes:
+        if self._cached is not None:
+            return self._cached
+
         encoder = message.message_encoder()
         results = list()
         encoder.send(None)
         encoder.send(self.material)
         results.append(encoder.send(SigRecord(0x2000)))
+        # Genuine Ultimaker spools carry two copies of the stat record. Keep both for printer compatibility
         results.append(encoder.send(self.status))
         results.append(encoder.send(self.status))
         results.append(encoder.send(None))
@@ -196,6 +251,7 @@ class MyFilamentSpool:
             result += b'\x00' * (4-len(result) % 4)
         print('   Size is now {} bytes, that is {} pages with {} excess.'.format(len(result), len(result)//4, len(result) % 4))
 
+        self._cached = result
         return result
 
 
@@ -212,28 +268,33 @@ Record.register_type(SigRecord)
 # /---------------------------------\
 #|          Main Functions           |
 # \---------------------------------/
+def _ui_material(record, state):
+    state['guid'] = str(record._material_id)
+
+def _ui_stat(record, state):
+    state['total'] = record._material_total
+    state['remain'] = record._material_remaining
+    state['time'] = record._total_usage_duration/3600
+    return True # The first stat record is all the ui needs
+
+'''Record type -> handler used by decode(ui=True). A handler returning True ends the decode'''
+_UI_HANDLERS = {UltimakerMaterialRecord: _ui_material, UltimakerStatRecord: _ui_stat}
+
 def decode(octets, ui=False):
     '''Decodes UM spool binary to records'''
     records = message.message_decoder(octets, errors='relax')
 
     if ui:
-        r_guid = ''
-        r_total = 0
-        r_remain = 0
-        r_time = 0
+        state = {'guid': '', 'total': 0, 'remain': 0, 'time': 0}
         try:
             for record in records:
-                if type(record) is UltimakerMaterialRecord:
-                    r_guid = str(record._material_id)
-                if type(record) is UltimakerStatRecord:
-                    r_total = record._material_total
-                    r_remain = record._material_remaining
-                    r_time = record._total_usage_duration/3600
+                handler = _UI_HANDLERS.get(type(record))
+                if handler is not None and handler(record, state):
                     break
         except:
-            return 1, r_guid, r_total, r_remain, r_time
+            return 1, state['guid'], state['total'], state['remain'], state['time']
         
-        return 0, r_guid, r_total, r_remain, r_time
+        return 0, state['guid'], state['total'], state['remain'], state['time']
     
     else:
         try:
@@ -276,7 +337,7 @@ def writeSpool(id, unit, tw, ui=False):
     service = None
     try:
         print('Waiting for tag...')
-        service = request.waitforcard()
+        service = _get_request().waitforcard()
     except CardRequestTimeoutException:
         print('No card detected after ', TIMEOUT, ' seconds. Aborting read.')
         if ui:
@@ -297,8 +358,9 @@ def writeSpool(id, unit, tw, ui=False):
         
         # Create spool data for this tag
         spool = MyFilamentSpool(uuid.UUID(id), serial, unit, tw)
-        decode(spool.data())
         tag_data = spool.data()
+        if not ui:
+            decode(tag_data)
 
         for i in range(0, len(tag_data), 4): # count from 0 to number of pages in steps of 4
             page = i//4 + 4
@@ -311,7 +373,8 @@ def writeSpool(id, unit, tw, ui=False):
                                                                  util.toHexString(recv),
                                                                  util.toHexString([sw1, sw2])))
         connection.transmit(beep)
-        decode(bytes(tag_data))
+        if not ui:
+            decode(tag_data)
 
     except NoCardException:
         print('ERROR: Card was removed')
@@ -320,7 +383,7 @@ def readSpool(ui=False):
     service = None
     try:
         print('Waiting for tag...')
-        service = request.waitforcard()
+        service = _get_request().waitforcard()
     except CardRequestTimeoutException:
         print('No card detected after ', TIMEOUT, ' seconds. Aborting read.')
         if ui:
@@ -339,16 +402,13 @@ def readSpool(ui=False):
         serial = hexlify(bytes(uid_data)).decode('latin').upper()
         print('UID = {}\tstatus = {}\tdata={}'.format(uid, status, uid_data))
 
-        data = list()
-        tagDataLength = 300 # Ultimaker doesn't write past ~225 anyway so read to 300
-        for i in range(0, tagDataLength, 4):
-            page = i//4 + 4
-            pdata, sw1, sw2 = connection.transmit(cmd_read_page(page))
+        tag_data = bytearray()
+        for i, apdu in enumerate(read_pages):
+            page = i*4 + 4
+            pdata, sw1, sw2 = connection.transmit(apdu)
             if not ui:
                 print('[{:02x}] = {}\tstatus = {}'.format(page, util.toHexString(pdata), util.toHexString([sw1, sw2])))
-            data.append(pdata)
-
-        tag_data = [item for sublist in data for item in sublist]
+            tag_data.extend(pdata)
 
     except (NoCardException, IndexError):
         print('ERROR: Card was removed')
@@ -374,8 +434,13 @@ def load_bin(file:str):
 # /---------------------------------\
 #|      Create Smartcard Objects     |
 # \---------------------------------/
-card_type = AnyCardType()
-request = CardRequest(timeout=TIMEOUT, cardType=card_type)
+_request = None # Created on first use so importing this module doesn't touch PC/SC
+
+def _get_request():
+    global _request
+    if _request is None:
+        _request = CardRequest(timeout=TIMEOUT, cardType=AnyCardType())
+    return _request
 
 
 
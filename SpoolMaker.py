@@ -28,9 +28,10 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # \---------------------------------/
 import sys
 import os
-import time
+import logging
+from itertools import islice
 
-from PyQt5 import QtWidgets, QtGui, uic, QtCore
+from PyQt5 import QtWidgets, QtGui, uic, QtCore, sip
 
 import CuraMaterial as c
 import NFCSpool as s
@@ -40,6 +41,8 @@ __copyright__ = 'Copyright 2021, Dale Osborne'
 __license__ = 'GPL'
 __version__ = '1.1.5'
 
+log = logging.getLogger(__name__)
+
 
 
 # /---------------------------------\
@@ -51,140 +54,223 @@ QtWidgets.QApplication.setAttribute(QtCore.Qt.AA_EnableHighDpiScaling, True)
 QtWidgets.QApplication.setAttribute(QtCore.Qt.AA_UseHighDpiPixmaps, True)
 
 # Resource loader for loading UI file with PyInstaller dist
+_basePath = getattr(sys, '_MEIPASS', os.path.abspath('.')) # Resolved once at import
+
 def resource_path(relPath):
-    try:
-        basePath = sys._MEIPASS
-    except Exception:
-        basePath = os.path.abspath('.')
-    return os.path.join(basePath, relPath)
+    return os.path.join(_basePath, relPath)
+
+def fmtWeight(mg:int) -> str:
+    '''Formats a tag weight for display, e.g. 750000 -> 750,000. The unit is in the field label'''
+    return f'{mg:,}'
 
 
 
 # /---------------------------------\
 #|          GUI Class (PyQt)         |
 # \---------------------------------/
+class NfcWorker(QtCore.QThread):
+    '''Runs a blocking NFCSpool call off the GUI thread and emits its return value'''
+    done = QtCore.pyqtSignal(object)
+
+    def __init__(self, fn, *args, parent=None):
+        super(NfcWorker, self).__init__(parent)
+        self.fn = fn
+        self.args = args
+
+    def run(self):
+        self.done.emit(self.fn(*self.args))
+
 class Ui(QtWidgets.QMainWindow):
     def __init__(self):
         super(Ui, self).__init__()
-        uic.loadUi(resource_path('gui.ui'), self)
+        uic.loadUi(resource_path('gui.ui'), self) # Also sets every named widget as an attribute of self
         self.setWindowIcon(QtGui.QIcon(resource_path('icon.ico')))
 
-        # Load installed materials
-        self.curaMaterials, self.mList = c.get_all_materials()
-
         # Material Selector
-        self.materialSelect = self.findChild(QtWidgets.QComboBox, 'combo_matSelector')
-        if self.mList is not None:
-            self.materialSelect.addItems(self.mList)
+        self.curaMaterials, self.mList = [], []
+        self._guidIndex = {} # GUID -> material, for looking up tags
+        self.materialSelect = self.combo_matSelector
         self.materialSelect.currentIndexChanged.connect(self.materialSelectionChange)
         
         # Material Information
-        self.infoBrand = self.findChild(QtWidgets.QLineEdit, 'line_brand')
-        self.infoBrand.setText(self.curaMaterials[0].brand)
-        self.infoMaterial = self.findChild(QtWidgets.QLineEdit, 'line_material')
-        self.infoMaterial.setText(self.curaMaterials[0].material)
-        self.infoColor = self.findChild(QtWidgets.QLineEdit, 'line_color')
-        self.infoColor.setText(self.curaMaterials[0].color)
-        self.infoGUID = self.findChild(QtWidgets.QLineEdit, 'line_guid')
-        self.infoGUID.setText(self.curaMaterials[0].guid)
+        self.infoBrand = self.line_brand
+        self.infoMaterial = self.line_material
+        self.infoColor = self.line_color
+        self.infoGUID = self.line_guid
 
         # NFC Tag Information
-        self.tagStatus = self.findChild(QtWidgets.QLineEdit, 'line_nfcStatus')
-        self.tagSerial = self.findChild(QtWidgets.QLineEdit, 'line_serial')
-        self.tagBrand = self.findChild(QtWidgets.QLineEdit, 'line_cbrand')
-        self.tagMaterial = self.findChild(QtWidgets.QLineEdit, 'line_cmaterial')
-        self.tagColor = self.findChild(QtWidgets.QLineEdit, 'line_ccolor')
-        self.tagGUID = self.findChild(QtWidgets.QLineEdit, 'line_cguid')
-        self.tagTWeight = self.findChild(QtWidgets.QLineEdit, 'line_totalweight')
-        self.tagRWeight = self.findChild(QtWidgets.QLineEdit, 'line_remainweight')
-        self.tagTime = self.findChild(QtWidgets.QLineEdit, 'line_printtime')
-
-        self.newWeight = self.findChild(QtWidgets.QLineEdit, 'line_nweight')
-
-        self.status = self.findChild(QtWidgets.QLineEdit, 'line_status')
-        self.statusColor = self.findChild(QtWidgets.QProgressBar, 'progressBar')
+        self.tagStatus = self.line_nfcStatus
+        self.tagSerial = self.line_serial
+        self.tagBrand = self.line_cbrand
+        self.tagMaterial = self.line_cmaterial
+        self.tagColor = self.line_ccolor
+        self.tagGUID = self.line_cguid
+        self.tagTWeight = self.line_totalweight
+        self.tagRWeight = self.line_remainweight
+        self.tagTime = self.line_printtime
+
+        self.newWeight = self.line_nweight
+        weightValidator = QtGui.QIntValidator(0, 10_000_000, self) # Weight in mg, digits only
+        weightValidator.setLocale(QtCore.QLocale.c()) # Same 750,000 grouping as fmtWeight
+        self.newWeight.setValidator(weightValidator)
+
+        self.status = self.line_status
+        self.statusColor = self.progressBar
         
         # Buttons
-        self.btnRead = self.findChild(QtWidgets.QPushButton, 'btn_read')
+        self.btnRead = self.btn_read
         self.btnRead.clicked.connect(self.readTag)
-        self.btnWrite = self.findChild(QtWidgets.QPushButton, 'btn_write')
+        self.btnWrite = self.btn_write
         self.btnWrite.clicked.connect(self.writeTag)
 
         # Menu Actions
-        self.actionExit = self.findChild(QtWidgets.QAction, 'actionExit')
         self.actionExit.triggered.connect(self.exit)
-        self.actionRescan = self.findChild(QtWidgets.QAction, 'actionRescan_Materials')
+        self.actionRescan = self.actionRescan_Materials
         self.actionRescan.triggered.connect(self.rescan)
-        self.actionRead = self.findChild(QtWidgets.QAction, 'actionRead_Tag')
+        self.actionRead = self.actionRead_Tag
         self.actionRead.triggered.connect(self.readTag)
-        self.actionWrite = self.findChild(QtWidgets.QAction, 'actionWrite_Tag')
+        self.actionWrite = self.actionWrite_Tag
         self.actionWrite.triggered.connect(self.writeTag)
 
+        self._worker = None # Running NfcWorker, if any
+
         # Show UI
         self.show()
         self.setStatus('Ready', True)
 
+        # Load installed materials once the window is up
+        self.loadMaterials()
+
     def exit(self):
-        print('Exiting')
+        log.debug('Exiting')
         self.close()
 
+    def closeEvent(self, event):
+        # A tag operation can't be interrupted, and closing mid-write would leave a half-written tag
+        if self._worker is not None and not sip.isdeleted(self._worker) and self._worker.isRunning():
+            log.debug('Close ignored, NFC operation in progress')
+            self.setStatus('Wait for the tag operation to finish', False)
+            event.ignore()
+            return
+        event.accept()
+
     def rescan(self):
         # Load installed materials
-        print('Reloading Cura materials...', end = '')
-        self.curaMaterials, self.mList = c.get_all_materials()
+        log.debug('Reloading Cura materials...')
+        self.loadMaterials()
+
+    def loadMaterials(self):
+        '''Streams the installed materials into the material selector without blocking the event loop'''
+        self.curaMaterials, self.mList = [], []
+        self._guidIndex = {}
         self.materialSelect.clear()
-        if self.mList is not None:
-            self.materialSelect.addItems(self.mList)
-        print('Done!')
+        self._matIter = c.iter_all_materials()
+        QtCore.QTimer.singleShot(0, self._loadMaterialBatch)
+
+    def _loadMaterialBatch(self, batchSize:int=25):
+        batch = list(islice(self._matIter, batchSize))
+        if not batch:
+            self.curaMaterials = tuple(self.curaMaterials) # Loaded, so read-only until the next rescan
+            log.debug('Loaded %d Cura materials', len(self.curaMaterials))
+            return
+        names = [mat.displayName() for mat in batch]
+        self.curaMaterials.extend(batch)
+        for mat in batch:
+            self._guidIndex.setdefault(mat.guid, mat) # First match wins, as in a linear scan
+        self.mList.extend(names)
+        self.materialSelect.addItems(names)
+        QtCore.QTimer.singleShot(0, self._loadMaterialBatch)
 
     def materialSelectionChange(self, i):
+        if i < 0: # Selector was cleared
+            return
         self.infoBrand.setText(self.curaMaterials[i].brand)
         self.infoMaterial.setText(self.curaMaterials[i].material)
         self.infoColor.setText(self.curaMaterials[i].color)
         self.infoGUID.setText(self.curaMaterials[i].guid)
     
+    def runNfc(self, onDone, fn, *args):
+        '''Starts fn(*args) on an NfcWorker and passes its result to onDone on the GUI thread'''
+        self.setNfcBusy(True)
+        self._worker = NfcWorker(fn, *args, parent=self)
+        self._worker.done.connect(lambda _: self.setNfcBusy(False))
+        self._worker.done.connect(onDone)
+        self._worker.finished.connect(self._worker.deleteLater)
+        self._worker.start()
+
+    def setNfcBusy(self, busy:bool):
+        # Only one NFC operation can use the reader at a time
+        for widget in (self.btnRead, self.btnWrite, self.actionRead, self.actionWrite):
+            widget.setEnabled(not busy)
+
     def readTag(self, post_write=False):
-        print('Reading Tag...')
+        log.debug('Reading Tag...')
         if not post_write:
             self.setStatus('Waiting for tag...', False)
-        cardStatus, uid, guid, total, remain, time = s.readSpool(ui=True)
-        if uid is not None:
-            self.tagSerial.setText(':'.join([uid[i:i+2] for i,j in enumerate(uid) if not (i%2)]))
-            if cardStatus == 0:
-                self.tagStatus.setText('Valid Spool Tag')
-                self.tagGUID.setText(guid)
-                self.tagTWeight.setText(str(total))
-                self.tagRWeight.setText(str(remain))
-                self.tagTime.setText(str(time))
+        self.runNfc(lambda result: self._onReadComplete(result, post_write), s.readSpool, True)
+
+    def _onReadComplete(self, result, post_write:bool):
+        cardStatus, uid, guid, total, remain, time = result
+        self.setUpdatesEnabled(False) # Set all fields first, then repaint once
+        try:
+            if uid is not None:
+                if uid != s.DEFAULT_SERIAL: # Already formatted when the tag was removed mid-read
+                    uid = bytes.fromhex(uid).hex(':').upper() # e.g. 04:A1:B2:...
+                self.tagSerial.setText(uid)
+                if cardStatus == 0:
+                    self.tagStatus.setText('Valid Spool Tag')
+                    self.tagGUID.setText(guid)
+                    self.tagTWeight.setText(fmtWeight(total))
+                    self.tagRWeight.setText(fmtWeight(remain))
+                    self.tagTime.setText(f'{time}')
                 
-                # Lookup material based on the GUID read from the tag
-                materialData = self.lookupMaterial(guid)
-                self.tagBrand.setText(materialData[0])
-                self.tagMaterial.setText(materialData[1])
-                self.tagColor.setText(materialData[2])
-                if not post_write:
-                    self.setStatus('Tag Read Successful', True)
-
-            elif cardStatus == 1:
-                self.tagStatus.setText('Blank Tag/Unknown Data')
-                if not post_write:
-                    self.setStatus('Tag Read Successful', True)
-
-            elif cardStatus == 2:
-                print('Tag was removed early')
-                self.setStatus('Tag Removed!', False)
-        else:
-            print('Read timed out')
-            self.setStatus('Tag Read Timed Out', False)
+                    # Lookup material based on the GUID read from the tag
+                    materialData = self.lookupMaterial(guid)
+                    self.tagBrand.setText(materialData[0])
+                    self.tagMaterial.setText(materialData[1])
+                    self.tagColor.setText(materialData[2])
+                    if not post_write:
+                        self.setStatus('Tag Read Successful', True)
+
+                elif cardStatus == 1:
+                    self.tagStatus.setText('Blank Tag/Unknown Data')
+                    if not post_write:
+                        self.setStatus('Tag Read Successful', True)
+
+                elif cardStatus == 2:
+                    log.warning('Tag was removed early')
+                    self.setStatus('Tag Removed!', False)
+            else:
+                log.warning('Read timed out')
+                self.setStatus('Tag Read Timed Out', False)
+        finally:
+            self.setUpdatesEnabled(True)
 
     def writeTag(self):
-        print('Writing Tag...')
+        log.debug('Writing Tag...')
+        i = self.materialSelect.currentIndex()
+        if i < 0: # Selector is empty while materials are (re)loading, or none were found
+            self.setStatus('No material selected', False)
+            return
+        # Parse with the validator's locale so 750,000 is accepted as well as 750000
+        weight, ok = self.newWeight.validator().locale().toInt(self.newWeight.text())
+        if not (ok and self.newWeight.hasAcceptableInput()): # Empty, or outside the validator's range
+            self.setStatus('Invalid weight', False)
+            return
         self.setStatus('Writing New Tag...', False)
-        guid = self.curaMaterials[self.materialSelect.currentIndex()].guid
+        guid = self.curaMaterials[i].guid
         unit = 2#mg
-        weight = int(self.newWeight.text())
-        s.writeSpool(guid, unit, weight)
-        time.sleep(1) # Wait 1 second
+        self.runNfc(self._onWriteDone, s.writeSpool, guid, unit, weight, True)
+
+    def _onWriteDone(self, result):
+        if result is not None: # writeSpool only returns a value when no tag was found
+            log.warning('Write timed out')
+            self.setStatus('Tag Write Timed Out', False)
+            return
+        self.setNfcBusy(True)
+        QtCore.QTimer.singleShot(1000, self._onWriteComplete) # Give the tag a second before reading it back
+
+    def _onWriteComplete(self):
         self.setStatus('Tag Write Successful', True)
         self.readTag(True) # Read tag which should now contain the new data
         
@@ -196,10 +282,10 @@ class Ui(QtWidgets.QMainWindow):
             self.statusColor.setValue(0)
     
     def lookupMaterial(self, guid:str):
-        print('Finding: {}'.format(guid))
-        for material in self.curaMaterials:
-            if material.guid == guid:
-                return [material.brand, material.material, material.color]
+        log.debug('Finding: %s', guid)
+        material = self._guidIndex.get(guid)
+        if material is not None:
+            return [material.brand, material.material, material.color]
         return ['!!', 'Material not in database', '!!']
 
 def main():